@@ -4,9 +4,11 @@
 import math
 from typing import Callable, Dict, Optional, Tuple, Union
 
+import jax
 from jax import numpy as jnp
 
 from axlearn.common.attention import (
+    NEG_INF,
     LearnedPositionalEmbedding,
     PipelinedTransformerLayer,
     RepeatedTransformerLayer,
@@ -284,6 +286,84 @@ class Model(BaseModel):
             num_targets=num_targets,
         )
 
+    def _metrics_fused(
+        self,
+        hidden_states: Tensor,
+        embed_weight: Tensor,
+        target_labels: Tensor,
+        vocab_chunk_size: int = 4096,
+    ) -> Dict[str, Tensor]:
+        """Computes cross-entropy metrics from hidden states without materializing full logits.
+
+        Fuses the LM head projection with the cross-entropy computation, streaming over chunks of
+        the vocabulary so that at most [batch_size, seq_len, vocab_chunk_size] logits are alive at
+        a time, vs. [batch_size, seq_len, vocab_size] for the `_metrics` path.
+
+        Args:
+            hidden_states: a float Tensor of shape [batch_size, seq_len, hidden_dim].
+            embed_weight: a float Tensor of shape [vocab_size, hidden_dim], the embedding weight
+                used by the decoder to compute logits from hidden states.
+            target_labels: an int Tensor of shape [batch_size, seq_len].
+            vocab_chunk_size: the number of vocab entries projected per scan step.
+
+        Returns:
+            A dict containing loss, per_token_loss, live_targets and num_targets, numerically
+            matching the corresponding entries returned by `_metrics`.
+
+        Raises:
+            NotImplementedError: If cfg.z_loss_scale is nonzero.
+        """
+        if self.config.z_loss_scale:
+            raise NotImplementedError("_metrics_fused does not support a nonzero z_loss_scale.")
+        live_targets = (target_labels != self.decoder.config.pad_token_id) & (target_labels >= 0)
+        num_targets = live_targets.sum()
+
+        vocab_size = embed_weight.shape[0]
+        num_chunks = -(-vocab_size // vocab_chunk_size)
+        weight = jnp.pad(embed_weight, ((0, num_chunks * vocab_chunk_size - vocab_size), (0, 0)))
+        weight = weight.reshape(num_chunks, vocab_chunk_size, -1)
+        chunk_offsets = jnp.arange(num_chunks) * vocab_chunk_size
+
+        def accumulate_chunk(carry, chunk):
+            weight_chunk, offset = chunk
+            max_logit, sum_exp, label_logit = carry
+            # [batch_size, seq_len, vocab_chunk_size].
+            logits = jnp.einsum("bld,nd->bln", hidden_states, weight_chunk)
+            if logits.dtype in (jnp.bfloat16, jnp.float16):
+                logits = logits.astype(jnp.float32)
+            # Mask out padded vocab entries in the final chunk.
+            logits = jnp.where(offset + jnp.arange(vocab_chunk_size) < vocab_size, logits, NEG_INF)
+            # Running log-sum-exp over the vocab axis.
+            new_max = jnp.maximum(max_logit, logits.max(axis=-1))
+            sum_exp = sum_exp * jnp.exp(max_logit - new_max) + jnp.exp(
+                logits - new_max[..., None]
+            ).sum(axis=-1)
+            # Pick up the target logit for labels that fall in this chunk.
+            index = target_labels - offset
+            in_chunk = jnp.logical_and(0 <= index, index < vocab_chunk_size)
+            gathered = jnp.take_along_axis(
+                logits, jnp.clip(index, 0, vocab_chunk_size - 1)[..., None], axis=-1
+            ).squeeze(-1)
+            label_logit = label_logit + jnp.where(in_chunk, gathered, 0.0)
+            return (new_max, sum_exp, label_logit), None
+
+        init = (
+            jnp.full(target_labels.shape, NEG_INF, dtype=jnp.float32),
+            jnp.zeros(target_labels.shape, dtype=jnp.float32),
+            jnp.zeros(target_labels.shape, dtype=jnp.float32),
+        )
+        (max_logit, sum_exp, label_logit), _ = jax.lax.scan(
+            accumulate_chunk, init, (weight, chunk_offsets)
+        )
+        per_token_loss = (max_logit + jnp.log(sum_exp) - label_logit) * live_targets
+        loss = per_token_loss.sum() / jnp.maximum(1, num_targets)
+        return dict(
+            loss=loss,
+            per_token_loss=per_token_loss,
+            live_targets=live_targets,
+            num_targets=num_targets,
+        )
+
 
 TransformerStackConfig = Union[
     StackedTransformerLayer.Config,
@@ -6,6 +6,7 @@ from typing import Any, Dict, Optional, Union
 
 import jax
 from absl import logging
+from jax import numpy as jnp
 
 from axlearn.common.config import Configurable
 from axlearn.common.module import Summable
@@ -36,6 +37,34 @@ class WeightedScalar(WeightedScalarValue, Summable):
         return WeightedScalar(mean, weight)
 
 
+def merge_summaries(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    """Merges two trees of WeightedScalar summaries into one.
+
+    Equivalent to accumulating with `WeightedScalar.__add__`, but implemented with traceable ops
+    only, so it can also be used under `jax.jit` or as a `jax.lax.scan` merge step.
+
+    Args:
+        a: A tree with WeightedScalar leaves.
+        b: A tree with the same structure as `a`.
+
+    Returns:
+        A tree with the same structure, where each WeightedScalar holds the weighted mean and
+        total weight of the corresponding leaves of `a` and `b`.
+    """
+
+    def merge(x: WeightedScalar, y: WeightedScalar) -> WeightedScalar:
+        weight = x.weight + y.weight
+        mean = jnp.where(
+            weight > 0,
+            (x.mean * x.weight + y.mean * y.weight) / jnp.where(weight > 0, weight, 1),
+            0.0,
+        )
+        return WeightedScalar(mean, weight)
+
+    is_leaf = lambda x: isinstance(x, WeightedScalar)
+    return jax.tree_util.tree_map(merge, a, b, is_leaf=is_leaf)
+
+
 class MetricAccumulator(Configurable):
     """A MetricAccumulator is used during evaluation to accumulate metrics across batches."""
 
@@ -55,7 +84,7 @@ class MetricAccumulator(Configurable):
         if not self._scalars:
             self._scalars = scalars
         else:
-            self._scalars = self._tree_map(lambda x, y: x + y, self._scalars, scalars)
+            self._scalars = merge_summaries(self._scalars, scalars)
         logging.debug("MetricAccumulator.update: merged=%s", self._scalars)
 
     def summaries(self) -> Dict[str, Any]:
@@ -183,6 +183,10 @@ class TestCase(parameterized.TestCase):
             )
         del layer_params
 
+        # Commit the converted parameters to device in one pass, rather than letting the
+        # invocation below transfer many small host arrays one by one.
+        params_from_ref = jax.tree_util.tree_map(jax.device_put, params_from_ref)
+
         test_outputs, _ = F(
             test_layer,
             is_training=False,